@@ -1,67 +1,319 @@
+import io
+import inspect
+import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.autograd import Function
 import torch.onnx
+from torch.onnx import symbolic_helper
 import onnx
 import onnxruntime as ort
 
+try:
+    import triton
+    import triton.language as tl
+except ImportError:
+    triton = None
+
+try:
+    from depth2space_cpu import d2s_crd_r2
+except ImportError:
+    d2s_crd_r2 = None
+
+# autotune候选的BLOCK_SIZE
+_TRITON_BLOCK_SIZES = (1024, 2048, 4096)
+
+if triton is not None:
+    @triton.autotune(
+        configs=[triton.Config({'BLOCK_SIZE': block}) for block in _TRITON_BLOCK_SIZES],
+        key=['n_elements'],
+    )
+    @triton.jit
+    def _depth_to_space_kernel(in_ptr, out_ptr, n_elements, C_out, H, W,
+                               R: tl.constexpr, IS_DCR: tl.constexpr,
+                               USE_INT32_IDX: tl.constexpr, BLOCK_SIZE: tl.constexpr):
+        # 以输出为中心：每个program处理一段连续的输出下标，直接反推输入下标，
+        # 读一次写一次，不再物化permute之后的中间结果
+        pid = tl.program_id(0)
+        if USE_INT32_IDX:
+            offs = pid * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
+        else:
+            offs = pid.to(tl.int64) * BLOCK_SIZE + tl.arange(0, BLOCK_SIZE)
+        mask = offs < n_elements
+
+        w_out = offs % (W * R)
+        t = offs // (W * R)
+        h_out = t % (H * R)
+        t = t // (H * R)
+        c_out = t % C_out
+        n = t // C_out
+
+        h_in = h_out // R
+        dy = h_out % R
+        w_in = w_out // R
+        dx = w_out % R
+        if IS_DCR:
+            c_in = (dy * R + dx) * C_out + c_out
+        else:
+            c_in = c_out * R * R + dy * R + dx
+
+        src = ((n * (C_out * R * R) + c_in) * H + h_in) * W + w_in
+        val = tl.load(in_ptr + src, mask=mask)
+        tl.store(out_ptr + offs, val, mask=mask)
+
+# ONNX导出方式：'DepthToSpace'直接生成DepthToSpace算子；
+# 'reshape-expand'展开为Reshape->Transpose->Reshape，方便ORT等推理引擎做图优化
+# 两种方式都依赖自定义Function的symbolic，只对TorchScript导出器生效（dynamo导出器会忽略symbolic），
+# 所以export_onnx会固定使用TorchScript导出器
+ONNX_EXPORT_MODE = 'DepthToSpace'
+
+def _perm_is_reshape(shape, perm):
+    # 只移动了大小为1的维度时，permute等价于reshape
+    kept = [p for p in perm if shape[p] != 1]
+    return kept == sorted(kept)
+
+def _onnx_reshape(g, input, shape):
+    return g.op("Reshape", input, g.op("Constant", value_t=torch.tensor(shape, dtype=torch.int64)))
+
+def _depth_to_space_symbolic(g, input, block_size, mode):
+    sizes = symbolic_helper._get_tensor_sizes(input)
+    if ONNX_EXPORT_MODE != 'reshape-expand' or sizes is None or None in sizes[1:]:
+        return g.op("DepthToSpace", input, blocksize_i=block_size, mode_s=mode)
+
+    # batch维用-1由其余维度推导，保留动态batch（C/H/W已要求是静态的）
+    _, c, h, w = sizes
+    c_out = c // (block_size ** 2)
+    if mode == 'DCR':
+        shape = [-1, block_size, block_size, c_out, h, w]
+        perm = [0, 3, 4, 1, 5, 2]
+    else:
+        shape = [-1, c_out, block_size, block_size, h, w]
+        perm = [0, 1, 4, 2, 5, 3]
+    out_shape = [-1, c_out, h * block_size, w * block_size]
+    if _perm_is_reshape(shape, perm):
+        return _onnx_reshape(g, input, out_shape)
+    tmp = _onnx_reshape(g, input, shape)
+    tmp = g.op("Transpose", tmp, perm_i=perm)
+    return _onnx_reshape(g, tmp, out_shape)
+
+def _depth_to_space_triton(input, block_size, mode):
+    input = input.contiguous()
+    b, c, h, w = input.size()
+    # kernel按C_out * R * R计算通道stride，C不能整除时结果会错位，必须报错
+    if c % (block_size ** 2) != 0:
+        raise ValueError("Expected channels ({}) to be divisible by block_size ** 2 ({})".format(
+            c, block_size ** 2))
+    out = input.new_empty((b, c // (block_size ** 2), h * block_size, w * block_size))
+    n_elements = out.numel()
+    grid = lambda meta: (triton.cdiv(n_elements, meta['BLOCK_SIZE']),)
+    # 最后一个block的下标会超出n_elements，最多超出一个BLOCK_SIZE
+    _depth_to_space_kernel[grid](input, out, n_elements, c // (block_size ** 2), h, w,
+                                 R=block_size, IS_DCR=(mode == 'DCR'),
+                                 USE_INT32_IDX=(n_elements + max(_TRITON_BLOCK_SIZES) < 2 ** 31))
+    return out
+
+# CPU分块路径每个分块的源数据字节数上限（覆盖整个batch和所有通道），按常见的L2大小取1MB
+DEPTH_TO_SPACE_TILE_BYTES = 1 << 20
+
+def _depth_to_space_6d(input, block_size, mode):
+    # 返回permute之后的6D view: (b, c_out, h, block_size, w, block_size)，不做拷贝
+    b, c, h, w = input.size()
+    c_out = c // (block_size ** 2)
+    if mode == 'DCR':
+        return input.view(b, block_size, block_size, c_out, h, w).permute(0, 3, 4, 1, 5, 2)
+    return input.view(b, c_out, block_size, block_size, h, w).permute(0, 1, 4, 2, 5, 3)
+
+def _depth_to_space_view(input, block_size, mode):
+    # reshape只有在无法用view表示时才会拷贝；block_size > 1时(h, block_size)一般无法合并，
+    # 实际上几乎总会拷贝一次，只是省掉了显式的.contiguous()
+    b, c, h, w = input.size()
+    return _depth_to_space_6d(input, block_size, mode).reshape(
+        b, c // (block_size ** 2), h * block_size, w * block_size)
+
+def _depth_to_space_tile_h(input, budget=DEPTH_TO_SPACE_TILE_BYTES):
+    # 一行源数据包含整个batch和所有通道，按字节预算换算出每个分块的行数
+    b, c, _, w = input.size()
+    return max(1, budget // max(1, b * c * w * input.element_size()))
+
+def _depth_to_space_tiled(input, block_size, mode, out=None, tile_h=None):
+    # 沿H方向分块做permute，直接写入预先分配好的输出，
+    # 同一块源数据被block_size*block_size个输出位置消费时仍在cache中
+    b, c, h, w = input.size()
+    if tile_h is None:
+        tile_h = _depth_to_space_tile_h(input)
+    c_out = c // (block_size ** 2)
+    shape = (b, c_out, h * block_size, w * block_size)
+    if out is None:
+        out = input.new_empty(shape)
+    elif tuple(out.shape) != shape:
+        raise ValueError("Expected output of shape {}, got {}".format(shape, tuple(out.shape)))
+    # copy_会静默做类型转换，dtype或device不一致时直接报错
+    elif out.dtype != input.dtype or out.device != input.device:
+        raise ValueError("Expected output with dtype {} on {}, got dtype {} on {}".format(
+            input.dtype, input.device, out.dtype, out.device))
+    elif not out.is_contiguous():
+        raise ValueError("Expected a contiguous output")
+    out6 = out.view(b, c_out, h, block_size, w, block_size)
+    # 整个输入放得进一个分块时不切片，直接一次拷贝
+    if tile_h >= h:
+        out6.copy_(_depth_to_space_6d(input, block_size, mode))
+        return out
+    for h0 in range(0, h, tile_h):
+        h1 = min(h0 + tile_h, h)
+        out6[:, :, h0:h1].copy_(_depth_to_space_6d(input[:, :, h0:h1, :], block_size, mode))
+    return out
+
+def _depth_to_space_out(input, block_size, mode, out):
+    # 写入用户提供的输出，不再经过.contiguous()产生中间结果；只有CPU上才分块
+    tile_h = None if input.device.type == 'cpu' else input.size(2)
+    return _depth_to_space_tiled(input, block_size, mode, out=out, tile_h=tile_h)
+
+def _output_buffer(buf, x, block_size):
+    # 形状、dtype和device都不变时复用上一次的输出
+    b, c, h, w = x.size()
+    shape = (b, c // (block_size ** 2), h * block_size, w * block_size)
+    if buf is None or tuple(buf.shape) != shape or buf.dtype != x.dtype or buf.device != x.device:
+        buf = x.new_empty(shape)
+    return buf
+
 class DepthToSpace_DCR(Function):
     @staticmethod
     def forward(ctx, input, block_size, mode):
-        b, c, h, w = input.size()
-        tmp = input.view(b, block_size, block_size, c // (block_size ** 2), h, w)
-        tmp = tmp.permute(0, 3, 4, 1, 5, 2).contiguous()
-        y = tmp.view(b, c // (block_size ** 2), h * block_size, w * block_size)
-        return y
+        if input.is_cuda and triton is not None:
+            return _depth_to_space_triton(input, block_size, 'DCR')
+        if input.device.type == 'cpu':
+            return _depth_to_space_tiled(input, block_size, 'DCR')
+        # reshape在需要时才拷贝，结果与.contiguous().view()一致；ONNX导出只看symbolic，不关心layout
+        return _depth_to_space_view(input, block_size, 'DCR')
 
     @staticmethod
     def symbolic(g, input, block_size, mode):
-        return g.op("DepthToSpace", input, blocksize_i=block_size, mode_s=mode)
+        return _depth_to_space_symbolic(g, input, block_size, mode)
     
 class DepthToSpace_CRD(Function):
     @staticmethod
     def forward(ctx, input, block_size, mode):
-        b, c, h, w = input.size()
-        tmp = input.view(b, c // (block_size ** 2), block_size, block_size, h, w)
-        tmp = tmp.permute(0, 1, 4, 2, 5, 3).contiguous()
-        y = tmp.view(b, c // (block_size ** 2), h * block_size, w * block_size)
-        return y
+        if input.is_cuda and triton is not None:
+            return _depth_to_space_triton(input, block_size, 'CRD')
+        # CRD模式与pixel_shuffle完全等价，直接使用PyTorch的原生kernel
+        return F.pixel_shuffle(input, block_size)
 
     @staticmethod
     def symbolic(g, input, block_size, mode):
-        return g.op("DepthToSpace", input, blocksize_i=block_size, mode_s=mode)
+        return _depth_to_space_symbolic(g, input, block_size, mode)
     
+class DepthToSpace_DCR_out(Function):
+    @staticmethod
+    def forward(ctx, input, out, block_size, mode):
+        _depth_to_space_out(input, block_size, 'DCR', out)
+        ctx.mark_dirty(out)
+        return out
+
+class DepthToSpace_CRD_out(Function):
+    @staticmethod
+    def forward(ctx, input, out, block_size, mode):
+        _depth_to_space_out(input, block_size, 'CRD', out)
+        ctx.mark_dirty(out)
+        return out
+
+# reuse_output=True时模块会缓存输出并在形状不变时复用，
+# 注意返回的tensor会被下一次调用覆盖，需要保留结果时请先clone
+# 导出ONNX时忽略out和reuse_output：原地写入out的Function无法被导出器追踪
 class DepthToSpace_DCR_Module(nn.Module):
-    def __init__(self, block_size, mode='DCR'):
+    def __init__(self, block_size, mode='DCR', reuse_output=False):
         super(DepthToSpace_DCR_Module, self).__init__()
         self.block_size = block_size
         self.mode = mode
+        self.reuse_output = reuse_output
+        self._out = None
 
-    def forward(self, x):
+    def forward(self, x, out=None):
+        if not torch.onnx.is_in_onnx_export():
+            if out is None and self.reuse_output:
+                self._out = _output_buffer(self._out, x, self.block_size)
+                out = self._out
+            if out is not None:
+                return DepthToSpace_DCR_out.apply(x, out, self.block_size, self.mode)
         return DepthToSpace_DCR.apply(x, self.block_size, self.mode)
     
 class DepthToSpace_CRD_Module(nn.Module):
-    def __init__(self, block_size, mode='CRD'):
+    def __init__(self, block_size, mode='CRD', reuse_output=False):
         super(DepthToSpace_CRD_Module, self).__init__()
         self.block_size = block_size
         self.mode = mode
+        self.pixel_shuffle = nn.PixelShuffle(block_size)
+        self.reuse_output = reuse_output
+        self._out = None
 
-    def forward(self, x):
-        return DepthToSpace_CRD.apply(x, self.block_size, self.mode)
+    def forward(self, x, out=None):
+        if not torch.onnx.is_in_onnx_export():
+            if out is None and self.reuse_output:
+                self._out = _output_buffer(self._out, x, self.block_size)
+                out = self._out
+            if out is not None:
+                return DepthToSpace_CRD_out.apply(x, out, self.block_size, self.mode)
+        # 只有导出ONNX时才走自定义Function，以便symbolic生成DepthToSpace算子
+        if torch.onnx.is_in_onnx_export():
+            return DepthToSpace_CRD.apply(x, self.block_size, self.mode)
+        # CPU上最常见的block_size=2使用numba kernel；该路径不支持autograd
+        # 通道数不是4的倍数时交给pixel_shuffle报错，而不是静默丢掉多余的通道
+        if (d2s_crd_r2 is not None and self.block_size == 2 and x.device.type == 'cpu'
+                and x.dim() == 4 and x.size(1) % 4 == 0
+                and x.dtype == torch.float32 and not (x.requires_grad and torch.is_grad_enabled())):
+            y = _output_buffer(None, x, self.block_size)
+            d2s_crd_r2(x.contiguous().numpy(), y.numpy())
+            return y
+        return self.pixel_shuffle(x)
     
-def create_model(block_size, mode):
+# 纯PyTorch实现交给torch.compile，Inductor可以与前后的算子（如前面的Conv2d）融合并做layout传播；
+# 不能导出ONNX，导出时请使用上面基于自定义Function的模块
+class DepthToSpace_DCR_Module_Compiled(nn.Module):
+    def __init__(self, block_size, mode='DCR'):
+        super(DepthToSpace_DCR_Module_Compiled, self).__init__()
+        self.block_size = block_size
+        self.mode = mode
+        self._depth_to_space = torch.compile(_depth_to_space_view, mode='reduce-overhead')
+
+    def forward(self, x):
+        return self._depth_to_space(x, self.block_size, 'DCR')
+
+class DepthToSpace_CRD_Module_Compiled(nn.Module):
+    def __init__(self, block_size, mode='CRD'):
+        super(DepthToSpace_CRD_Module_Compiled, self).__init__()
+        self.block_size = block_size
+        self.mode = mode
+        self._pixel_shuffle = torch.compile(F.pixel_shuffle, mode='reduce-overhead')
+
+    def forward(self, x):
+        return self._pixel_shuffle(x, self.block_size)
+
+def create_model(block_size, mode, for_export=True):
     if mode == 'DCR':
-        return DepthToSpace_DCR_Module(block_size)
+        if for_export:
+            return DepthToSpace_DCR_Module(block_size)
+        return DepthToSpace_DCR_Module_Compiled(block_size)
     elif mode == 'CRD':
-        return DepthToSpace_CRD_Module(block_size)
+        if for_export:
+            return DepthToSpace_CRD_Module(block_size)
+        return DepthToSpace_CRD_Module_Compiled(block_size)
     else:
         raise ValueError("Unknown mode: {}".format(mode))
     
 def export_onnx(model, x, onnx_path):
-    torch.onnx.export(model, x, onnx_path, opset_version=11,
-                      input_names=['input'], output_names=['output'])
-    onnx_model = onnx.load(onnx_path)
+    # 先导出到内存中检查，再写盘，避免从刚写好的文件重新解析一遍protobuf
+    buf = io.BytesIO()
+    # torch 2.9起默认dynamo=True，会忽略symbolic，需要显式指定TorchScript导出器
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False
+    torch.onnx.export(model, x, buf, opset_version=11,
+                      input_names=['input'], output_names=['output'], **kwargs)
+    onnx_bytes = buf.getvalue()
+    onnx_model = onnx.load_from_string(onnx_bytes)
     onnx.checker.check_model(onnx_model)
+    with open(onnx_path, "wb") as f:
+        f.write(onnx_bytes)
     print("Model is checked!")
 
 def test_depth_to_space():
@@ -69,20 +321,79 @@ def test_depth_to_space():
     print(f"Input: \n{x}")
     block_size = 2
     modes = ['DCR', 'CRD']
+    x_np = x.numpy()
+    # 两个session共用同一份SessionOptions
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    # 有GPU时使用CUDA EP，并通过IOBinding直接绑定device上的输入输出，省去每次run的H2D/D2H拷贝
+    available_providers = ort.get_available_providers()
+    providers = [p for p in ['CUDAExecutionProvider', 'CPUExecutionProvider'] if p in available_providers]
+    use_cuda = torch.cuda.is_available() and 'CUDAExecutionProvider' in providers
+    if use_cuda:
+        x_cuda = x.cuda()
+    outputs = {}
     for mode in modes:
         model = create_model(block_size, mode)
         model_name = "depth_to_space_" + mode + ".onnx"
         export_onnx(model, x, model_name)
-        ort_session = ort.InferenceSession(model_name)
-        outputs = ort_session.run(None, {'input': x.numpy()})
-        print(f"Mode: {mode}, output: \n{outputs[0]}")
+        ort_session = ort.InferenceSession(model_name, sess_options, providers=providers)
+        if use_cuda:
+            io_binding = ort_session.io_binding()
+            io_binding.bind_input('input', 'cuda', 0, np.float32, tuple(x_cuda.shape), x_cuda.data_ptr())
+            io_binding.bind_output('output', 'cuda')
+            ort_session.run_with_iobinding(io_binding)
+            outputs[mode] = io_binding.copy_outputs_to_cpu()[0]
+        else:
+            outputs[mode] = ort_session.run(None, {'input': x_np})[0]
+        print(f"Mode: {mode}, output: \n{outputs[mode]}")
 
-    pixel_shuffle = nn.PixelShuffle(2)
-    y = pixel_shuffle(x).detach().numpy()
-    print(f"PixelShuffle output: \n{y}")
+    pixel_shuffle = nn.PixelShuffle(block_size)
+    with torch.inference_mode():
+        y = pixel_shuffle(x)
+    print(f"PixelShuffle output: \n{y.numpy()}")
 
     # pixelshuffle的输出和自定义的DepthToSpace_CRD的输出应该是一样的
-    assert torch.allclose(torch.tensor(y), torch.tensor(outputs[0]), atol=1e-6), "Outputs are not equal!"
+    assert torch.allclose(y, torch.from_numpy(outputs['CRD']), atol=1e-6), "Outputs are not equal!"
+
+    # out=和reuse_output=True的结果应与普通路径一致
+    module_classes = {'DCR': DepthToSpace_DCR_Module, 'CRD': DepthToSpace_CRD_Module}
+    with torch.no_grad():
+        for mode in modes:
+            expected = module_classes[mode](block_size)(x)
+            buf = torch.empty_like(expected)
+            y_out = module_classes[mode](block_size)(x, out=buf)
+            assert y_out.data_ptr() == buf.data_ptr(), f"Mode: {mode}, out= was not written in place!"
+            assert torch.equal(y_out, expected), f"Mode: {mode}, out= outputs are not equal!"
+            reuse_model = module_classes[mode](block_size, reuse_output=True)
+            y_first = reuse_model(x).clone()
+            y_second = reuse_model(x)
+            assert y_second.data_ptr() == reuse_model._out.data_ptr(), f"Mode: {mode}, output buffer was not reused!"
+            assert torch.equal(y_first, expected) and torch.equal(y_second, expected), \
+                f"Mode: {mode}, reuse_output outputs are not equal!"
+
+    # numba路径（CPU、float32、block_size=2）的结果应与PixelShuffle一致
+    if d2s_crd_r2 is not None:
+        x_rand = torch.rand(2, 16, 5, 7)
+        with torch.no_grad():
+            y_numba = DepthToSpace_CRD_Module(2)(x_rand)
+            y_ref = nn.PixelShuffle(2)(x_rand)
+        assert torch.equal(y_numba, y_ref), "numba outputs are not equal!"
+
+    # 'reshape-expand'导出的Reshape->Transpose->Reshape应与DepthToSpace算子的结果一致
+    global ONNX_EXPORT_MODE
+    ONNX_EXPORT_MODE = 'reshape-expand'
+    try:
+        for mode in modes:
+            model_name = "depth_to_space_" + mode + "_reshape_expand.onnx"
+            export_onnx(create_model(block_size, mode), x, model_name)
+            op_types = [node.op_type for node in onnx.load(model_name).graph.node]
+            assert "DepthToSpace" not in op_types, f"Mode: {mode}, unexpected ops: {op_types}"
+            ort_session = ort.InferenceSession(model_name, sess_options, providers=['CPUExecutionProvider'])
+            expanded = ort_session.run(None, {'input': x_np})[0]
+            print(f"Mode: {mode} (reshape-expand), ops: {op_types}, output: \n{expanded}")
+            assert np.allclose(expanded, outputs[mode], atol=1e-6), "Outputs are not equal!"
+    finally:
+        ONNX_EXPORT_MODE = 'DepthToSpace'
 
 
 
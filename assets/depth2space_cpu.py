@@ -0,0 +1,23 @@
+import numba
+from numba import prange
+
+# cache=True把编译结果缓存到磁盘，避免每个进程第一次调用都要JIT编译
+@numba.njit(parallel=True, cache=True)
+def d2s_crd_r2(input_nchw, output):
+    """
+    CRD模式、block_size=2的DepthToSpace，结果写入output。
+    output[n, c, 2h+dy, 2w+dx] = input[n, 4c+2dy+dx, h, w]
+    """
+    N, C, H, W = input_nchw.shape
+    C_out = C // 4
+    # 按(n, c_out)并行，batch为1时也能用满所有核
+    for nc in prange(N * C_out):
+        n = nc // C_out
+        c = nc % C_out
+        for h in range(H):
+            for w in range(W):
+                # 每个2x2输出块对应4个输入通道的同一位置，最内层循环无分支，便于向量化
+                output[n, c, 2 * h, 2 * w] = input_nchw[n, 4 * c, h, w]
+                output[n, c, 2 * h, 2 * w + 1] = input_nchw[n, 4 * c + 1, h, w]
+                output[n, c, 2 * h + 1, 2 * w] = input_nchw[n, 4 * c + 2, h, w]
+                output[n, c, 2 * h + 1, 2 * w + 1] = input_nchw[n, 4 * c + 3, h, w]
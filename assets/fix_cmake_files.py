@@ -1,27 +1,30 @@
 #!/usr/bin/env python
 import os
 import re
+import mmap
 import sys
 import argparse
 import logging
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List
+from typing import List, Optional
+
+# 需要处理的文件后缀
+SUFFIXES = (".cmake", ".pc")
 
 class PathReplacer:
     def __init__(self, cmake_sysroot_var: str = "${CMAKE_SYSROOT}"):
         self.cmake_sysroot_var = cmake_sysroot_var
         # 利用负向前瞻（negative lookbehind）匹配不包含${CMAKE_SYSROOT}前缀的"/"
         # 使用(?=/|$)确保后面是路径分隔符或字符串结束，防止匹配/usrxxx或/optxxx
-        self.pattern_usr = r'(?<!\$\{CMAKE_SYSROOT\})(/usr)(?=/|$)'
-        # self.pattern_lib = r'(?<!\$\{CMAKE_SYSROOT\})(/lib)'
-        # self.pattern_bin = r'(?<!\$\{CMAKE_SYSROOT\})(/bin)'
-        # self.pattern_share = r'(?<!\$\{CMAKE_SYSROOT\})(/share)'
-        # self.pattern_etc = r'(?<!\$\{CMAKE_SYSROOT\})(/etc)'
-        # self.pattern_include = r'(?<!\$\{CMAKE_SYSROOT\})(/include)'
-        self.pattern_opt = r'(?<!\$\{CMAKE_SYSROOT\})(/opt)(?=/|$)'
-        # self.patterns = [self.pattern_usr, self.pattern_lib, self.pattern_bin, self.pattern_share, self.pattern_etc, self.pattern_include, self.pattern_opt]
-        self.patterns = [self.pattern_usr, self.pattern_opt]
+        # 所有前缀合并成一个分支模式，整个文件只需扫描一遍
+        # 如需处理更多前缀（/lib, /bin, /share, /etc, /include），加到分支里即可
+        self.prefixes = ["usr", "opt"]
+        self._pattern = re.compile(
+            r'(?<!\$\{CMAKE_SYSROOT\})(/(?:' + '|'.join(self.prefixes) + r'))(?=/|$)')
+        # bytes版本，直接在mmap上匹配，不需要先解码整个文件
+        self._pattern_b = re.compile(self._pattern.pattern.encode())
 
     def replace_paths(self, content: str) -> str:
         """
@@ -29,12 +32,21 @@ class PathReplacer:
         ${CMAKE_SYSROOT}/usr, ${CMAKE_SYSROOT}/opt
         但如果已有前缀则不再替换。
         """
-        # re.subn 返回 (new_content, 替换次数)，方便调试
-        for pattern in self.patterns:
-            new_content, count = re.subn(pattern, f'{self.cmake_sysroot_var}\\1', content)
-            if count > 0:
-                logging.debug(f"Replaced {count} occurrences.")
-                content = new_content
+        # subn 返回 (new_content, 替换次数)，方便调试
+        content, count = self._pattern.subn(f'{self.cmake_sysroot_var}\\1', content)
+        if count > 0:
+            logging.debug(f"Replaced {count} occurrences.")
+        return content
+
+    def has_paths(self, content) -> bool:
+        """判断bytes内容（或mmap）中是否存在需要替换的路径。"""
+        return self._pattern_b.search(content) is not None
+
+    def replace_paths_bytes(self, content: bytes) -> bytes:
+        """replace_paths的bytes版本。"""
+        content, count = self._pattern_b.subn(self.cmake_sysroot_var.encode() + b'\\1', content)
+        if count > 0:
+            logging.debug(f"Replaced {count} occurrences.")
         return content
 
 class CMakeFileProcessor:
@@ -45,16 +57,22 @@ class CMakeFileProcessor:
     def process_file(self, file_path: str) -> bool:
         """Process a single CMake file."""
         try:
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read()
-            updated_content = self.replacer.replace_paths(content)
-            if updated_content != content:
-                if self.backup:
-                    self._create_backup(file_path)
-                with open(file_path, "w", encoding="utf-8") as f:
-                    f.write(updated_content)
-                logging.info(f"Modified file: {file_path}")
-                return True
+            with open(file_path, "rb") as f:
+                # 空文件无法mmap，也不需要处理
+                if os.fstat(f.fileno()).st_size == 0:
+                    return False
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # 绝大多数文件不含需要替换的路径，先search，命中后才读出内容
+                    if not self.replacer.has_paths(mm):
+                        return False
+                    content = mm[:]
+            updated_content = self.replacer.replace_paths_bytes(content)
+            if self.backup:
+                self._create_backup(file_path)
+            with open(file_path, "wb") as f:
+                f.write(updated_content)
+            logging.info(f"Modified file: {file_path}")
+            return True
         except IOError as e:
             logging.error(f"Error processing file {file_path}: {e}")
         return False
@@ -71,38 +89,65 @@ class CMakeFileProcessor:
 class LogWriter:
     def __init__(self, rootfs_dir: str):
         self.rootfs_dir = rootfs_dir
+        # rootfs_dir是绝对路径，文件都来自对它的遍历，直接去掉前缀即可得到相对路径
+        self._rootfs_prefix = os.path.join(self.rootfs_dir, "")
         self.log_file_path = os.path.join(self.rootfs_dir, "fix_cmake_files.log")
         self.modified_files: List[str] = []
 
     def log_modified_file(self, file_path: str) -> None:
-        relative_path = os.path.relpath(file_path, self.rootfs_dir)
+        if file_path.startswith(self._rootfs_prefix):
+            relative_path = file_path[len(self._rootfs_prefix):]
+        else:
+            relative_path = os.path.relpath(file_path, self.rootfs_dir)
         self.modified_files.append(relative_path)
 
     def write_log(self) -> None:
+        header = f"\n--- Run at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---\n"
+        body = "".join(f"Modified: {file_path}\n" for file_path in self.modified_files)
         try:
             with open(self.log_file_path, "a", encoding="utf-8") as log_file:
-                log_file.write(f"\n--- Run at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ---\n")
-                for file_path in self.modified_files:
-                    log_file.write(f"Modified: {file_path}\n")
+                log_file.write(header + body)
             logging.info(f"Log of modified files appended to: {self.log_file_path}")
         except IOError as e:
             logging.error(f"Error writing log file: {e}")
 
 class FixCMakeFilesApp:
-    def __init__(self, rootfs_dir: str, backup: bool = True):
+    def __init__(self, rootfs_dir: str, backup: bool = True, jobs: Optional[int] = None):
         self.rootfs_dir = os.path.abspath(rootfs_dir)
+        self.jobs = jobs or os.cpu_count()
         self.replacer = PathReplacer()
         self.processor = CMakeFileProcessor(self.replacer, backup)
         self.log_writer = LogWriter(self.rootfs_dir)
 
+    def _collect_files(self) -> List[str]:
+        """Collect all CMake/pkg-config files under the rootfs."""
+        file_paths: List[str] = []
+        self._scan_dir(self.rootfs_dir, file_paths)
+        return file_paths
+
+    def _scan_dir(self, subdir: str, file_paths: List[str]) -> None:
+        # 先用DirEntry.name过滤后缀，匹配后才用到完整路径
+        # 不跟随符号链接，避免处理到rootfs之外（如宿主机/usr下）的文件
+        try:
+            with os.scandir(subdir) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        self._scan_dir(entry.path, file_paths)
+                    elif entry.name.endswith(SUFFIXES) and entry.is_file(follow_symlinks=False):
+                        file_paths.append(entry.path)
+        except OSError as e:
+            logging.warning(f"Failed to scan directory {subdir}: {e}")
+
     def run(self) -> None:
         """Run the CMake file fixing process."""
-        for subdir, _, files in os.walk(self.rootfs_dir):
-            for file in files:
-                if file.endswith(".cmake") or file.endswith(".pc"):
-                    file_path = os.path.join(subdir, file)
-                    if self.processor.process_file(file_path):
-                        self.log_writer.log_modified_file(file_path)
+        file_paths = self._collect_files()
+        # 每个文件的处理相互独立，用线程池并行；mmap路径不需要pickle编译好的正则
+        # 日志仍在主线程中按顺序记录
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            results = executor.map(self.processor.process_file, file_paths)
+            for file_path, modified in zip(file_paths, results):
+                if modified:
+                    self.log_writer.log_modified_file(file_path)
         self.log_writer.write_log()
 
 def main() -> None:
@@ -114,6 +159,8 @@ def main() -> None:
     parser.add_argument("--no-backup", action="store_true", help="Disable backup creation")
     parser.add_argument("--sysroot", type=str, default="${CMAKE_SYSROOT}",
                         help="Sysroot prefix to use (default: ${CMAKE_SYSROOT})")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker threads (default: number of CPUs)")
     args = parser.parse_args()
 
     log_level = logging.DEBUG if args.verbose else logging.INFO
@@ -122,7 +169,7 @@ def main() -> None:
     backup = not args.no_backup
     # 根据命令行参数构造 PathReplacer
     replacer = PathReplacer(args.sysroot)
-    app = FixCMakeFilesApp(args.directory, backup)
+    app = FixCMakeFilesApp(args.directory, backup, args.jobs)
     # 更新App中的replacer实例
     app.replacer = replacer
     app.processor.replacer = replacer
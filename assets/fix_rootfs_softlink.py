@@ -3,11 +3,38 @@ import sys
 import os
 import argparse
 import logging
+from collections import OrderedDict
 from typing import Generator, Tuple
 
+# 最多缓存的目录fd个数，避免目录过多时耗尽fd
+DIRFD_CACHE_SIZE = 64
+
 class SymlinkConverter:
     def __init__(self, topdir: str):
         self.topdir = os.path.abspath(topdir)
+        self._topdir_len = len(self.topdir)
+        # 以目录fd为基准做unlink/symlink，内核不必每次都从头解析很长的topdir前缀
+        self._use_dir_fd = os.unlink in os.supports_dir_fd and os.symlink in os.supports_dir_fd
+        self._dirfd_flags = os.O_DIRECTORY | getattr(os, "O_PATH", os.O_RDONLY)
+        self._dirfd_cache: "OrderedDict[str, int]" = OrderedDict()
+
+    def _get_dirfd(self, subdir: str) -> int:
+        """Return a cached directory fd for subdir, evicting the least recently used one if needed."""
+        dfd = self._dirfd_cache.get(subdir)
+        if dfd is not None:
+            self._dirfd_cache.move_to_end(subdir)
+            return dfd
+        dfd = os.open(subdir, self._dirfd_flags)
+        self._dirfd_cache[subdir] = dfd
+        if len(self._dirfd_cache) > DIRFD_CACHE_SIZE:
+            _, old_dfd = self._dirfd_cache.popitem(last=False)
+            os.close(old_dfd)
+        return dfd
+
+    def _close_dirfds(self) -> None:
+        while self._dirfd_cache:
+            _, dfd = self._dirfd_cache.popitem()
+            os.close(dfd)
 
     def handle_link(self, filep: str, subdir: str) -> None:
         """
@@ -21,32 +48,58 @@ class SymlinkConverter:
         if not link.startswith('/') or link.startswith(self.topdir):
             return
 
-        new_link = os.path.relpath(self.topdir + link, subdir)
+        # subdir一定位于topdir之下，它相对topdir的深度就是需要回退的'../'个数
+        # 只有开启DEBUG日志（-v）时才与os.path.relpath的结果做校验，避免拖慢正常运行
+        depth = subdir.count('/', self._topdir_len)
+        new_link = '../' * depth + link.lstrip('/') or '.'
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            assert os.path.normpath(os.path.join(subdir, new_link)) == \
+                os.path.normpath(os.path.join(subdir, os.path.relpath(self.topdir + link, subdir)))
         logging.info(f"Replacing {link} with {new_link} for {filep}")
 
         try:
-            os.unlink(filep)
-            os.symlink(new_link, filep)
+            if self._use_dir_fd:
+                dfd = self._get_dirfd(subdir)
+                name = os.path.basename(filep)
+                os.unlink(name, dir_fd=dfd)
+                os.symlink(new_link, name, dir_fd=dfd)
+            else:
+                os.unlink(filep)
+                os.symlink(new_link, filep)
         except OSError as e:
             logging.error(f"Failed to replace symlink {filep}: {e}")
 
     def walk_directory(self) -> Generator[Tuple[str, str], None, None]:
         """
-        Walk through the directory and yield files that are symlinks.
+        Walk through the directory and yield entries that are symlinks.
 
         Yields:
             Tuple[str, str]: A tuple containing the full path to a symlink and its containing directory
         """
-        for subdir, _, files in os.walk(self.topdir):
-            for f in files:
-                filep = os.path.join(subdir, f)
-                if os.path.islink(filep):
-                    yield filep, subdir
+        yield from self._walk(self.topdir)
+
+    def _walk(self, subdir: str) -> Generator[Tuple[str, str], None, None]:
+        # DirEntry缓存了dirent类型，is_symlink/is_dir不需要额外的lstat
+        # 先取出完整的目录项列表，避免替换链接时影响正在进行的遍历
+        try:
+            with os.scandir(subdir) as it:
+                entries = list(it)
+        except OSError as e:
+            logging.warning(f"Failed to scan directory {subdir}: {e}")
+            return
+        for entry in entries:
+            if entry.is_symlink():
+                yield entry.path, subdir
+            elif entry.is_dir(follow_symlinks=False):
+                yield from self._walk(entry.path)
 
     def convert_symlinks(self) -> None:
         """Convert all absolute symlinks in the directory to relative ones."""
-        for filep, subdir in self.walk_directory():
-            self.handle_link(filep, subdir)
+        try:
+            for filep, subdir in self.walk_directory():
+                self.handle_link(filep, subdir)
+        finally:
+            self._close_dirfds()
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Convert absolute symlinks to relative ones in a sysroot directory.")